@@ -13,11 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from datetime import datetime
+from tempfile import TemporaryDirectory
+from concurrent.futures import ThreadPoolExecutor
 import pandas as pd
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from .logging import log
-from .future_algo import Future, guess_algo, future_val
+from .future_algo import Future, guess_algo, future_val_batch
 
 _stockaid_cache = None
 
@@ -80,7 +84,8 @@ class LSTMHistory:
     """
 
     def __init__(self, look_back, look_ahead, test_ratio=0.2, will_train=True,
-                 will_predict=True, future_history=0):
+                 will_predict=True, future_history=0, seed=None,
+                 future_backing=None):
         """If you are training an LSTM to predict stock prices based on
            historic values, use this class to wrangle data. This works well
            with the TDA historic api registered with the cache.
@@ -97,8 +102,14 @@ class LSTMHistory:
                we know the future for already. Defaults to 0. Use 1 if you wish
                to calibrate or filter future predictions based on how far off
                the prediction is from the last value. See last_val().
-           :raises ValueError: if look_back, look_ahead, or test_ratio are out
-               of range.
+           :param seed: if provided, seeds the random choice of which data
+               points are used for testing, so that the split is repeatable.
+           :param future_backing: can be set to 'memmap' to reduce memory
+               usage when predicting on a large number of tags. The future
+               data of each tag is then stored in a temporary file, and
+               future_data() returns a read-only numpy memmap of it.
+           :raises ValueError: if look_back, look_ahead, test_ratio, or
+               future_backing are out of range.
         """
         if look_back <= 0:
             raise ValueError("look_back must be > 0")
@@ -106,6 +117,8 @@ class LSTMHistory:
             raise ValueError("look_ahead must be > 0")
         if test_ratio < 0 or test_ratio >= 1:
             raise ValueError("test_ratio must be >= 0")
+        if future_backing not in [None, 'memmap']:
+            raise ValueError("future_backing must be None or 'memmap'")
 
         self.look_back = look_back
         self.look_ahead = look_ahead
@@ -113,23 +126,60 @@ class LSTMHistory:
         self.keep_train = will_train
         self.keep_future = will_predict
         self.future_history = future_history
-        self.count_fit = 0
-        self.count_test = 0
-        self.fit_x = np.array([])
-        self.fit_y = np.array([])
-        self.test_x = np.array([])
-        self.test_y = np.array([])
+        self._rng = np.random.default_rng(seed)
+        # each ingest adds a chunk, and chunks are concatenated when read
+        self._fit_x_chunks = [np.empty((0, look_back), dtype=np.float32)]
+        self._fit_y_chunks = [np.empty(0, dtype=np.float32)]
+        self._test_x_chunks = [np.empty((0, look_back), dtype=np.float32)]
+        self._test_y_chunks = [np.empty(0, dtype=np.float32)]
         self.future = {}
+        self._future_dir = None
+        self._future_files = 0
+        if future_backing == 'memmap':
+            self._future_dir = TemporaryDirectory()
         self.scale = {}
         self.lval = {}
 
 
+    # same as ((x / m) - 1.0) * 5.0, but m is often a column of per-window
+    # values, so multiply by the reciprocal instead of dividing every element
     def _ascale(self, x, m):
-        return ((x / m) - 1.0) * 5.0
+        x = x * (5.0 / m)
+        x -= 5.0
+        return x
 
     def _aunscale(self, x, m):
         return ((x / 5.0) + 1.0) * m
 
+    @property
+    def count_fit(self):
+        """The number of data points in the fit set"""
+        return sum(len(c) for c in self._fit_y_chunks)
+
+    @property
+    def count_test(self):
+        """The number of data points in the test set"""
+        return sum(len(c) for c in self._test_y_chunks)
+
+    # write a to a new file in the future dir, and map it back read-only. A
+    # new file is used each time, since an old map of a tag may still be held.
+    def _memmap(self, a):
+        path = os.path.join(self._future_dir.name,
+                            '{}.dat'.format(self._future_files))
+        self._future_files = self._future_files + 1
+        mm = np.memmap(path, dtype=np.float32, mode='w+', shape=a.shape)
+        mm[:] = a
+        mm.flush()
+        del mm
+        return np.memmap(path, dtype=np.float32, mode='r', shape=a.shape)
+
+    # concatenate just once, however many times ingest was called, and keep
+    # the result as the only chunk so that the next read is free
+    def _concat(self, chunks):
+        if len(chunks) > 1:
+            chunks[:] = [np.concatenate(chunks)]
+        return chunks[0]
+
     def ingest(self, df, tag, date_col='datetime', val_col='close',
                future_algo=Future.FUTURE_DEFAULT, train_min=10.0,
                train_max=300.0):
@@ -171,47 +221,41 @@ class LSTMHistory:
         if future_algo == Future.FUTURE_DEFAULT:
             future_algo = guess_algo(val_col)
 
-        # copy, sort (oldest first), and index
-        df = df.copy()
-        df = df.sort_values(date_col)
-
-        # decision variable for which set the row is added to
-        split = np.random.random(len(df))
-
-        # data as a one dimensional ndarray of floats from val_col
-        s = np.array(df[val_col], dtype=float).flatten()
-        self.lval[tag] = s[-1]
+        # data as a one dimensional, contiguous ndarray of float32 from
+        # val_col, sorted (oldest first). Only the two columns we use are
+        # sorted, and not at all if they already are. The last val is kept
+        # at full precision.
+        dates = df[date_col].to_numpy()
+        vals = df[val_col].to_numpy()
+        s = np.ascontiguousarray(vals, dtype=np.float32)
+        last = -1
+        if not np.all(dates[:-1] <= dates[1:]):
+            order = np.argsort(dates, kind='stable')
+            s = s[order]
+            last = order[-1]
+        self.lval[tag] = float(vals[last])
 
         # training data
         if self.keep_train:
-            # numpy append does not scale well, so build small arrays and
-            # append just once instead of in a loop
-            tx = []
-            ty = []
-            fx = []
-            fy = []
-            for i in range(lb, len(s) - la):
-                # scale each history / future independent of the others
-                x = s[i-lb+1:i+la+1]    # mixed data, history and future
-                #m = np.mean(x)
-                m = s[i]
-                x = self._ascale(x,m)
-                if np.amax(x) > 1.0 or np.amin(x) < -1.0 or m < train_min or m > train_max:
-                    continue
-                y = future_val(x[lb:], future_algo)
-                x = x[:lb]
-                if split[i] < self.test_ratio:
-                    tx.append(x)
-                    ty.append(y)
-                    self.count_test = self.count_test + 1
-                else:
-                    fx.append(x)
-                    fy.append(y)
-                    self.count_fit = self.count_fit + 1
-            self.test_x = np.append(self.test_x,tx).reshape(self.count_test,lb)
-            self.test_y = np.append(self.test_y,ty)
-            self.fit_x = np.append(self.fit_x,fx).reshape(self.count_fit,lb)
-            self.fit_y = np.append(self.fit_y,fy)
+            # each row of w is a window of mixed data, history and future.
+            # Scale each window independent of the others, by the last value
+            # in its history.
+            w = sliding_window_view(s, lb + la)[1:]
+            m = s[lb:len(s) - la]
+            x = self._ascale(w, m[:, np.newaxis])
+            keep = ~((np.amax(x, axis=1) > 1.0) | (np.amin(x, axis=1) < -1.0) |
+                     (m < train_min) | (m > train_max))
+            # decision variable for which set the window is added to
+            split = self._rng.random(len(m), dtype=np.float32)
+            is_test = split < self.test_ratio
+            tmask = keep & is_test
+            fmask = keep & ~is_test
+
+            y = future_val_batch(x[:, lb:], future_algo)
+            self._test_x_chunks.append(x[tmask, :lb])
+            self._test_y_chunks.append(y[tmask])
+            self._fit_x_chunks.append(x[fmask, :lb])
+            self._fit_y_chunks.append(y[fmask])
 
         # future data
         if self.keep_future:
@@ -221,14 +265,16 @@ class LSTMHistory:
                 start = 0
             x = s[start:]
             #self.scale[tag] = np.mean(x)
-            self.scale[tag] = s[-1]    # the last val
+            self.scale[tag] = self.lval[tag]    # the last val
             x = self._ascale(x, self.scale[tag])
 
-            # now reshape the data as a series of lb-sized histories
-            f = np.array([])
-            for i in range(lb, len(x)):
-                f = np.append(f, x[i-lb+1:i+1])
-            self.future[tag] = f.reshape(len(x)-lb, lb)
+            # now reshape the data as a series of lb-sized histories. The rows
+            # of the view overlap, so copy them out into their own block
+            f = sliding_window_view(x, lb)[1:]
+            if self._future_dir:
+                self.future[tag] = self._memmap(f)
+            else:
+                self.future[tag] = np.ascontiguousarray(f)
 
 
     def ingest_symbol(self, symbol, period, ptype, freq_type, val_col='close'):
@@ -244,15 +290,12 @@ class LSTMHistory:
            :raises ValueError: if the val_col is not valid or the data set has
                too few rows to accommodate the look_back and look_ahead.
         """
-        global _stockaid_cache
-        hist = _stockaid_cache.api('TDA', 'history', symbol=symbol,
-                                   periodType=ptype, period=period,
-                                   frequencyType=freq_type)
+        hist = _fetch_history(symbol, period, ptype, freq_type)
         self.ingest(hist, symbol, val_col=val_col)
 
 
     def ingest_index(self, index, period, ptype, freq_type, val_col='close',
-                     omit=[], quiet=False):
+                     omit=[], quiet=False, max_workers=16):
         """Fetch each stock symbol in a given index registered with the cache.
            The stock histories are fetched using the TDA history api. During
            ingest(), the symbol name is used as the tag. If the cache needs to
@@ -268,40 +311,55 @@ class LSTMHistory:
            :param quiet: if True, will suppress log messages related to each
                stock that is ingested. You can also set the log level less than
                2 (info) to suppress these messages.
+           :param max_workers: the number of histories to fetch in parallel.
+               Fetches still respect the TDA provider's throttle, and the
+               histories are ingested in index order.
            :raises ValueError: if the val_col is not valid or the data set has
                too few rows to accommodate the look_back and look_ahead.
         """
         global _stockaid_cache
         ts = datetime.now().timestamp()
         idx_list = _stockaid_cache.api('index',index)['Symbol']
-        for symbol in idx_list:
-            if symbol in omit:
-                continue
-            self.ingest_symbol(symbol, period, ptype, freq_type, val_col)
-            if not quiet:
-                end = datetime.now().timestamp()
-                log(2, "Ingest {} in {:.3f} seconds".format(symbol,end-ts))
-                ts=end
+        omit = set(omit)
+        symbols = [symbol for symbol in idx_list if symbol not in omit]
+
+        # fetching is mostly waiting on the network, so fetch in parallel,
+        # but ingest on this thread so that our arrays have a single writer
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            hists = [pool.submit(_fetch_history, symbol, period, ptype,
+                                 freq_type) for symbol in symbols]
+            try:
+                for symbol, hist in zip(symbols, hists):
+                    self.ingest(hist.result(), symbol, val_col=val_col)
+                    if not quiet:
+                        end = datetime.now().timestamp()
+                        log(2, "Ingest {} in {:.3f} seconds".format(symbol,
+                                                                    end-ts))
+                        ts=end
+            except:
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
 
 
     def fit_data(self):
         """When training, the fitness function will need X, Y data that
            contains the look_back and look_ahead values, respectively.
 
-           :returns: two numpy ndarrays representing the X and Y data for your
-               model's fit function.
+           :returns: two numpy ndarrays of float32 representing the X and Y
+               data for your model's fit function.
         """
-        return self.fit_x, self.fit_y
+        return (self._concat(self._fit_x_chunks),
+                self._concat(self._fit_y_chunks))
 
     def test_data(self):
         """When evaluating your model, the reserved test data is needed. After
            running predictions on this data, you will need to run the
            score_test function to evaluate the performace of the model.
 
-           :returns: a numpy ndarray containing the X data for your model's
-               predict function.
+           :returns: a numpy ndarray of float32 containing the X data for your
+               model's predict function.
         """
-        return self.test_x
+        return self._concat(self._test_x_chunks)
 
     def score_test(self, predictions):
         """After fitting your model, as a test, you should predict on the
@@ -318,12 +376,15 @@ class LSTMHistory:
                that your model always misses in the same direction (negative,
                if MPE is negative).
         """
-        t = self.test_y
-        p = np.array(predictions).reshape(t.shape)
+        t = self._concat(self._test_y_chunks)
+        p = np.asarray(predictions, dtype=t.dtype).reshape(t.shape)
         # these sets are already scaled so that the decimal value is a percentage
-        # so there is no need to divide by t and risk div0 errors
-        mape = np.mean(np.abs((p-t)/5.0))
-        mpe = np.mean((p-t)/5.0)
+        # so there is no need to divide by t and risk div0 errors. Compute the
+        # errors once, in one buffer, and take both means from it.
+        r = np.subtract(p, t, dtype=np.float64)
+        r /= 5.0
+        mpe = r.mean()
+        mape = np.abs(r, out=r).mean()
         log(2, "ML test score: MAPE={:.4f}, MPE={:.4f}".format(mape,mpe))
 
         return mape, mpe
@@ -338,7 +399,7 @@ class LSTMHistory:
 
            :param tag: the tag provided when the data was ingested, or the
                symbol name if ingest_symbol or ingest_index was used.
-           :returns: an ndarray with shape=(rows,look_back) of floats that
+           :returns: an ndarray with shape=(rows,look_back) of float32 that
                contains the X parameter for your model's predict function, or
                None if tag is not valid.
         """
@@ -357,7 +418,8 @@ class LSTMHistory:
         """
         if self.scale.get(tag) is None:
             return None
-        return np.array(self._aunscale(predictions, self.scale[tag])).flatten()
+        p = np.asarray(predictions)
+        return np.array(self._aunscale(p, self.scale[tag])).flatten()
 
 
     def last_val(self, tag):
@@ -379,6 +441,11 @@ class LSTMHistory:
         for t in self.future.keys():
             yield t
 
+def _fetch_history(symbol, period, ptype, freq_type):
+    return _stockaid_cache.api('TDA', 'history', symbol=symbol,
+                               periodType=ptype, period=period,
+                               frequencyType=freq_type)
+
 def register_LSTM(cache):
     global _stockaid_cache
     _stockaid_cache = cache
@@ -25,10 +25,22 @@ import os
 from datetime import datetime
 from tempfile import TemporaryDirectory
 from shutil import copyfile
-from subprocess import run
+from subprocess import run, Popen, PIPE
+import numpy as np
 import pandas as pd
 from ..logging import log
 
+# characters that are rejected in paths and solver names passed to spawn()
+_DIRTY = frozenset('$&<>!?~(){}[];#`\\=|* \t\r\n')
+
+# one pass over s for the characters, plus a check for parent dirs
+def _is_dirty(s):
+    return not _DIRTY.isdisjoint(s) or '..' in s
+
+# None until a spawn() shows whether flatzinc reads its program from stdin
+_pipe_ok = None
+
+
 def dzn(df, coltype):
     """Transforms a pandas DataFrame into a string formated for a .dzn file.
        MiniZinc has strict typing, so a dict, coltype, maps column names to a
@@ -46,56 +58,45 @@ def dzn(df, coltype):
     """
     if not coltype or df is None:
         return None
-    out=""
+    out = []
 
     # persuade Series or ndarray to become a comma separated string
     def comma_list(s):
-        return ','.join(str(x) for x in s)
+        return ','.join(np.asarray(s).astype(str))
 
-    # emumerated type definitions must go first
+    # iterate through columns and output, while collecting the values of
+    # each enumerated type
     enum = {}
-    # loop once to make sure we have all the value
-    for k in coltype:
-        t = coltype[k]
-        if t not in ['int','float','bool','string','len']:
-            if enum.get(t) is None:
-                enum[t] = df[k]
-            else:
-                enum[t] = enum[t].append(df[k])
-    # then loop through the enums and output a unique set of values
-    for t in enum:
-        s = enum[t].unique()
-        out = out + "{} = {{ {} }};\n".format(t, comma_list(s))
-
-    # this is clearer than a lambda. Allow any type with a truth value.
-    def convert_bool(x):
-        if x:
-            return 'true'
-        else:
-            return 'false'
-
-    # iterate through columns and output
-    for k in coltype:
-        t = coltype[k]
-
+    for k, t in coltype.items():
         # variables of type len are not actually in the DataFrame
         if t == 'len':
-            out = out + "{} = {};\n".format(k, len(df))
+            out.append("{} = {};\n".format(k, len(df)))
             continue
 
-        # format the column data
+        # format the column data. Allow any bool type with a truth value.
         s = df[k]
         if t == 'bool':
-            s = s.apply(convert_bool) # MiniZinc bools are lower case
+            # MiniZinc bools are lower case
+            s = np.where(s.to_numpy(dtype=bool), 'true', 'false')
         elif t == 'int':
             s = s.astype(int)
         elif t == 'float':
             s = s.astype(float)
         elif t == 'string':
-            s = s.apply(lambda x: '"' + x + '"') # strings need to be quoted
-        out = out + "{} = [{}];\n".format(k, comma_list(s))
+            # strings need to be quoted
+            s = np.char.add(np.char.add('"', s.to_numpy().astype(str)), '"')
+        else:
+            enum.setdefault(t, []).append(s.to_numpy())
+        out.append("{} = [{}];\n".format(k, comma_list(s)))
+
+    # emumerated type definitions must go first, with a unique set of values
+    # in the order that they appear
+    defs = []
+    for t, a in enum.items():
+        s = pd.unique(np.concatenate(a))
+        defs.append("{} = {{ {} }};\n".format(t, comma_list(s)))
 
-    return out
+    return ''.join(defs + out)
 
 
 def spawn(mzn_path, df, coltype, multiple=False, solver=None):
@@ -111,97 +112,148 @@ def spawn(mzn_path, df, coltype, multiple=False, solver=None):
        :returns: either a Result, if multiple is False, or an array of Result.
     """
     dzn_str = dzn(df, coltype)
-    res_str = None
 
     # sanatize mzn_path, solver to discourage string injection
-    dirty = ['$','..','&','<','>','!','?','~','(',')','{','}','[',']',';','#',
-             '`','\\','=','|','*',' ','\t','\r','\n']
-    if mzn_path and any(x in mzn_path for x in dirty):
+    if mzn_path and _is_dirty(mzn_path):
         log(1, 'Possible string injection in MiniZinc.spawn() mzn_path')
-        raise ValueError('solver is rejected to avoid string injection')
-    if solver and any(x in solver for x in dirty):
+        raise ValueError('mzn_path is rejected to avoid string injection')
+    if solver and _is_dirty(solver):
         log(1, 'Possible string injection in Minizinc.spawn() solver')
         raise ValueError('solver is rejected to avoid string injection')
 
     # MiniZinc makes a mess, so isolate it in a temp dir
+    global _pipe_ok
     with TemporaryDirectory() as temp_dir:
         mzn_temp = os.path.join(temp_dir, 'frompy.mzn')
         dzn_temp = os.path.join(temp_dir, 'frompy.dzn')
 
-        fz_args = ['flatzinc', '-o', 'fz.out']
+        fz_opts = []
         if multiple:
-            fz_args.append('-a')
+            fz_opts.append('-a')
         if solver:
-            fz_args.append('--solver')
-            fz_args.append(solver)
-        fz_args.append('frompy.fzn')
+            fz_opts.append('--solver')
+            fz_opts.append(solver)
 
         # copy in the program, write the data file
         copyfile(mzn_path, mzn_temp)
         with open(dzn_temp, 'w') as f:
             f.write(dzn_str)
 
-        # compile MiniZinc into a FlatZinc program
-        start = datetime.now().timestamp()
-        done = run(['minizinc', '-c', mzn_temp, dzn_temp], cwd=temp_dir)
-        end = datetime.now().timestamp()
-        if done.returncode != 0:
-            log(1, 'MiniZinc for {} returned error code {}.'.format(mzn_path,
-                done.returncode))
-            return None
-        log(2, 'Compiled {} in {:.3f} seconds'.format(mzn_path, end-start))
-
-        # use solver to solve FlatZinc program
-        start = end
-        done = run(fz_args, cwd=temp_dir)
-        end = datetime.now().timestamp()
-        if done.returncode != 0:
-            log(1, 'Flatzinc for {} returned error code {}.'.format(mzn_path,
-                done.returncode))
-            return None
-        log(2, 'FlatZinc ran in {:.3f} seconds.'.format(end-start))
-
-        # read the output file
-        with open(os.path.join(temp_dir, 'fz.out'), 'rt') as f:
-            res_str = f.read()
-
-    # iterate through res_str creating Result objects
-    ret = []
-    while res_str and res_str[:3] != "===":
-        result = Result(res_str)
-        if result.str_len == -1:
-            res_str = None
-        else:
-            res_str = res_str[result.str_len:]
-        if multiple:
-            ret.append(result)
-        else:
-            return result
+        # pipe minizinc into flatzinc, unless we have already seen that
+        # flatzinc cannot read its program from stdin. Until we know, a
+        # failure is retried through files, and quietly.
+        ret = None
+        if _pipe_ok is not False:
+            ret = _run_piped(mzn_path, temp_dir, mzn_temp, dzn_temp, fz_opts,
+                             multiple, 1 if _pipe_ok else 3)
+            if ret is not None:
+                _pipe_ok = True
+        if ret is None and not _pipe_ok:
+            ret = _run_files(mzn_path, temp_dir, mzn_temp, dzn_temp, fz_opts,
+                             multiple)
+            if ret is not None and _pipe_ok is None:
+                _pipe_ok = False
+
+    if ret is None:
+        return None
     if multiple:
         return ret
+    if ret:
+        return ret[0]
     return None
 
 
-class Result():
-    """This class reads strings that are output by FlatZinc."""
+# iterate through lines of FlatZinc output creating Result objects
+def _read_results(lines, multiple):
+    ret = []
+    while True:
+        result = Result(lines)
+        if not result.solved and not result.data:
+            break
+        ret.append(result)
+        if not multiple or not result.solved:
+            break
+    return ret
+
+
+# compile MiniZinc into a FlatZinc program on a pipe straight into the
+# solver, and stream the solutions from its stdout
+def _run_piped(mzn_path, temp_dir, mzn_temp, dzn_temp, fz_opts, multiple,
+               level):
+    start = datetime.now().timestamp()
+    mz = Popen(['minizinc', '-c', '--output-fzn-to-stdout', mzn_temp,
+                dzn_temp], cwd=temp_dir, stdout=PIPE)
+    fz = Popen(['flatzinc'] + fz_opts + ['-'], cwd=temp_dir, stdin=mz.stdout,
+               stdout=PIPE, text=True)
+    mz.stdout.close()   # so minizinc sees a broken pipe if flatzinc exits
+    ret = _read_results(fz.stdout, multiple)
+    fz.communicate()
+    mz.wait()
+    end = datetime.now().timestamp()
+    if mz.returncode != 0:
+        log(level, 'MiniZinc for {} returned error code {}.'.format(mzn_path,
+            mz.returncode))
+        return None
+    if fz.returncode != 0:
+        log(level, 'Flatzinc for {} returned error code {}.'.format(mzn_path,
+            fz.returncode))
+        return None
+    log(2, 'Compiled and ran {} in {:.3f} seconds.'.format(mzn_path,
+        end-start))
+    return ret
+
+
+# compile MiniZinc into a FlatZinc file, then solve it into an output file
+def _run_files(mzn_path, temp_dir, mzn_temp, dzn_temp, fz_opts, multiple):
+    start = datetime.now().timestamp()
+    done = run(['minizinc', '-c', mzn_temp, dzn_temp], cwd=temp_dir)
+    end = datetime.now().timestamp()
+    if done.returncode != 0:
+        log(1, 'MiniZinc for {} returned error code {}.'.format(mzn_path,
+            done.returncode))
+        return None
+    log(2, 'Compiled {} in {:.3f} seconds'.format(mzn_path, end-start))
+
+    # use solver to solve FlatZinc program
+    start = end
+    done = run(['flatzinc', '-o', 'fz.out'] + fz_opts + ['frompy.fzn'],
+               cwd=temp_dir)
+    end = datetime.now().timestamp()
+    if done.returncode != 0:
+        log(1, 'Flatzinc for {} returned error code {}.'.format(mzn_path,
+            done.returncode))
+        return None
+    log(2, 'FlatZinc ran in {:.3f} seconds.'.format(end-start))
 
-    str_len = 0
-    data = {}
+    # stream the output file into Result objects, each of which reads
+    # the lines of one solution
+    with open(os.path.join(temp_dir, 'fz.out'), 'rt') as f:
+        return _read_results(f, multiple)
 
-    def __init__(self, res_str):
-        """Import into data dict the values found in s. The format of s should
-           match the format of either a .dzn or FlatZinc output
 
-           :param res_str: a string containing FlatZinc output
+class Result():
+    """This class reads the output of FlatZinc, one solution at a time."""
+
+    def __init__(self, res):
+        """Import into data dict the values found in res. The format of res
+           should match the format of either a .dzn or FlatZinc output. Lines
+           are read up to the end of one solution, so when res is an iterator
+           (e.g. an open file), the next Result will read the next solution.
+
+           :param res: a string containing FlatZinc output, or an iterator
+               over its lines.
         """
-        while res_str and res_str[self.str_len:self.str_len+3] != '---':
-            idx = res_str.find('\n', self.str_len)
-            if idx < 0:
-                self.str_len = -1
+        self.data = {}
+        self.solved = False   # True if the '---' after a solution was read
+        if isinstance(res, str):
+            res = iter(res.splitlines())
+        for line in res:
+            if line.startswith('---'):
+                self.solved = True
+                break
+            if line.startswith('==='):
                 break
-            else:
-                self._parse_line(res_str[self.str_len:idx])
-                self.str_len = idx + 1
+            self._parse_line(line.rstrip('\r\n'))
 
 
     def get_df(self, columns):
@@ -222,34 +274,33 @@ class Result():
 
 
     def _unquote(self, val):
-        if val[0:1] == '"':
-            return val[1:len(val)-1]
-        elif val.find('[') >= 0:
-            start = val.find('[') + 1
+        if val.startswith('"'):
+            return val[1:-1]
+        elif '[' in val:
+            start = val.index('[') + 1
             end = val.find(']', start)
             return self._parse_array(val[start:end])
-        elif val.find('.') >= 0:
-            return float(val)
-        elif val.isnumeric():
-            return int(val)
         elif val == 'false':
             return False
         elif val == 'true':
             return True
-        else:
+        # only a token that starts like a number is one. Anything else, such
+        # as an enum value named inf or nan, is an identifier.
+        if not val or not (val[0].isdigit() or val[0] in '-.'):
+            return val
+        try:
+            return int(val)
+        except ValueError:
+            pass
+        try:
+            return float(val)
+        except ValueError:
             return val
 
     def _parse_array(self, arr):
-        a = []
-        start = 0
-        while True:
-            idx = arr.find(',', start)
-            if idx < 0:
-                a.append(self._unquote(arr[start:].strip()))
-                return a
-            else:
-                a.append(self._unquote(arr[start:idx].strip()))
-                start = idx + 1
+        if not arr.strip():
+            return []
+        return [self._unquote(v.strip()) for v in arr.split(',')]
 
     def _parse_line(self, line):
         # label = value;
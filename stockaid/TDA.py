@@ -69,9 +69,14 @@
 """
 
 from .throttle import LazyTokenBucket
-import json
 import pandas as pd
 
+# orjson is optional, but parses responses several times faster than json
+try:
+    from orjson import loads as _loads
+except ImportError:
+    from json import loads as _loads
+
 
 # 52WkHigh 52WkLow askId askPrice askSize assetMainType assetSubType assetType
 # bidId bidPrice bidSize bidTick closePrice cusip delayed description digits
@@ -83,38 +88,32 @@ import pandas as pd
 # regularMarketPercentChangeInDouble regularMarketTradeTimeInLong
 # securityStatus shortable symbol totalVolume tradeTimeInLong volatility
 def pandify_quote(resp):
-    return pd.read_json(resp, orient='index', convert_dates=False)
+    # one row per symbol, built directly from the parsed response
+    try:
+        obj = _loads(resp)
+    except:
+        return None
+    if not obj:
+        return None
+    return pd.DataFrame.from_dict(obj, orient='index')
 
 
 # columns=['datetime','open','close','high','low','volume']
 def pandify_history(resp):
     try:
-        obj = json.loads(resp)
+        obj = _loads(resp)
         if obj['empty']:
             return None
-        candles = json.dumps(obj["candles"])
+        candles = obj["candles"]
     except:
         return None
-    df = pd.read_json(candles, orient='records', convert_dates=False)
-    df = df.sort_values('datetime')
-    return df
-
-
-# internal function that flattens json
-def _iter_options(df, ul, ul_last, options):
-    for date in options:
-        for strike in options[date]:
-            for x in options[date][strike]:
-                y = json.dumps({0:x})
-                o = pd.read_json(y, orient='index')
-                o['expDate'] = date
-                o['strike'] = strike
-                o['underlying'] = ul
-                o['underlyingLast'] = ul_last
-                if df is not None:
-                    df = df.append(o)
-                else:
-                    df = o
+    if not candles:
+        return None
+    # the candles are already parsed, so build the DataFrame directly. The
+    # datetime is int ms, and is left that way.
+    df = pd.DataFrame.from_records(candles)
+    if not df['datetime'].is_monotonic_increasing:
+        df = df.sort_values('datetime', kind='mergesort', ignore_index=True)
     return df
 
 
@@ -124,16 +123,41 @@ def _iter_options(df, ul, ul_last, options):
 # we flatten. You should note that the documentation is wrong for the *Price
 # fields, e.g. what the docs call 'askPrice' is actually just 'ask'.
 def pandify_chains(resp):
-    df = None
     try:
-        obj = json.loads(resp)
+        obj = _loads(resp)
         ul = obj['underlying']['symbol']
         ul_last = obj['underlying']['last']
-        df = _iter_options(df, ul, ul_last, obj['callExpDateMap'])
-        df = _iter_options(df, ul, ul_last, obj['putExpDateMap'])
+        # flatten into one record per option, calls and then puts
+        records = [{**x, 'expDate': date, 'strike': strike,
+                    'underlying': ul, 'underlyingLast': ul_last}
+                   for options in (obj['callExpDateMap'],
+                                   obj['putExpDateMap'])
+                   for date, strikes in options.items()
+                   for strike, opts in strikes.items()
+                   for x in opts]
     except:
         return None
 
+    if not records:
+        return None
+    return _nan_strings(pd.DataFrame.from_records(records))
+
+
+# TDA sends values it can't compute, e.g. the greeks of some options, as the
+# string "NaN". Columns holding them would mix floats and strings, which the
+# parquet cache can't store, so each is made numeric, if the rest of it is.
+def _nan_strings(df):
+    for c in df.columns:
+        col = df[c]
+        if pd.api.types.is_numeric_dtype(col):
+            continue
+        nan = col.eq('NaN')
+        if not nan.any():
+            continue
+        try:
+            df[c] = pd.to_numeric(col.mask(nan))
+        except (ValueError, TypeError):
+            pass
     return df
 
 
@@ -143,12 +167,14 @@ def register_TDA(cache):
                        'https://api.tdameritrade.com/v1/marketdata/', throt)
     cache.register_api('TDA', 'quote', '{symbol}/quotes', 'symbol',
                        pandify_quote, key_map={'apikey':'TDA'},
-                       url_params=['symbol'], cache_secs=60)
+                       url_params=['symbol'], cache_secs=60, binary=True)
     cache.register_api('TDA', 'history', '{symbol}/pricehistory', 'symbol',
                        pandify_history, key_map={'apikey':'TDA'},
                        url_params=['symbol'], cache_secs=86400,
-                       data_params=['periodType','period','frequencyType'])
+                       data_params=['periodType','period','frequencyType'],
+                       binary=True)
     cache.register_api('TDA', 'chains', 'chains', 'symbol', pandify_chains,
                        key_map={'apikey':'TDA'}, cache_secs=180,
                        data_params=['symbol','includeQuotes','range',
-                                    'fromDate', 'toDate','optionType'])
+                                    'fromDate', 'toDate','optionType'],
+                       binary=True)
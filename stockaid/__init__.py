@@ -21,14 +21,46 @@
 
 __version__ = "0.2"
 
-_stockaid_cache = None
+import importlib
 
-from .cache import APICache
-from .future_algo import Future
-from .index import register_index
-from .TDA import register_TDA
-from .LSTM import LSTMHistory, register_LSTM
-from . import greeks, MiniZinc, logging
+# keep the existing cache across importlib.reload, so that reloading doesn't
+# create a second cache and register every throttler and api all over again
+_stockaid_cache = globals().get('_stockaid_cache')
+
+# the public names, and the submodule that provides each. These are imported
+# on first use, so that importing stockaid (or just one piece of it) doesn't
+# pay to import pandas, requests, and the rest of the package up front. A None
+# attribute means the name is the submodule itself.
+_LAZY = {
+    'APICache': ('.cache', 'APICache'),
+    'Future': ('.future_algo', 'Future'),
+    'register_index': ('.index', 'register_index'),
+    'register_TDA': ('.TDA', 'register_TDA'),
+    'LSTMHistory': ('.LSTM', 'LSTMHistory'),
+    'register_LSTM': ('.LSTM', 'register_LSTM'),
+    'greeks': ('.greeks', None),
+    'MiniZinc': ('.MiniZinc', None),
+    'logging': ('.logging', None),
+}
+
+__all__ = ['get_cache'] + list(_LAZY)
+
+def __getattr__(name):
+    try:
+        mod, attr = _LAZY[name]
+    except KeyError:
+        raise AttributeError(
+            "module {!r} has no attribute {!r}".format(__name__, name)
+        ) from None
+    val = importlib.import_module(mod, __name__)
+    if attr:
+        val = getattr(val, attr)
+    # bind it, so later lookups don't come back here
+    globals()[name] = val
+    return val
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
 
 def get_cache(cache_path=None, key_chain=None, mode=0o777):
     """Create the cache singleton, or return the existing one. The first time
@@ -44,6 +76,11 @@ def get_cache(cache_path=None, key_chain=None, mode=0o777):
     global _stockaid_cache
 
     if not _stockaid_cache:
+        from .cache import APICache
+        from .index import register_index
+        from .TDA import register_TDA
+        from .LSTM import register_LSTM
+
         _stockaid_cache = APICache(cache_path, key_chain, mode)
         register_index(_stockaid_cache)
         register_TDA(_stockaid_cache)
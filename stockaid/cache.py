@@ -17,9 +17,42 @@
 
 import os
 import time
-from datetime import datetime
+import importlib.util
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
+from .logging import log
+
+# parquet keeps dtypes, and is smaller and much faster than csv, but it
+# needs pyarrow, which is optional
+if importlib.util.find_spec('pyarrow'):
+    _CACHE_EXT = 'parquet'
+else:
+    _CACHE_EXT = 'csv'
+
+def _read_cache(path):
+    if _CACHE_EXT == 'parquet':
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+# returns False if df could not be written, e.g. if a column holds a mix of
+# types that parquet cannot represent. No partial file is left behind.
+def _write_cache(df, path):
+    try:
+        if _CACHE_EXT == 'parquet':
+            df.to_parquet(path, compression='zstd')
+        else:
+            df.to_csv(path)
+    except Exception as e:
+        log(2, 'Not caching {}: {}'.format(path, e))
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    return True
 
 # returns False if the dir exists and is not writable, or if the dir cannot
 # be created with a writable mode.
@@ -35,17 +68,45 @@ def _check_cache_dir(path,  mode):
 class APICache:
     """This class implements the caching, throttled, api cache. Normally, a
        singleton is used, which can be accessed with the function
-       stockaid.get_cache()
+       stockaid.get_cache(). Up to mem_size of the most recently used results
+       are also kept in memory, so that repeated calls skip the disk.
     """
 
-    def __init__(self, cache_path=None, key_chain=None, mode=0o777):
+    def __init__(self, cache_path=None, key_chain=None, mode=0o777,
+                 mem_size=64):
         self.cache_path = cache_path
         self.key_chain = key_chain
         self.mode = mode
         self.providers = {}
+        # recent results are also kept in memory, least recently used first,
+        # as a map from (provider, name, cache key) to (expiry time, df)
+        self.mem_size = mem_size
+        self._mem = OrderedDict()
+        self._mem_lock = threading.Lock()
         if not _check_cache_dir(cache_path, self.mode):
             self.cache_path = None
 
+    # returns a copy of an unexpired DataFrame from memory, or None
+    def _mem_get(self, key):
+        with self._mem_lock:
+            hit = self._mem.get(key)
+            if hit is None:
+                return None
+            if hit[0] <= time.time():
+                del self._mem[key]
+                return None
+            self._mem.move_to_end(key)
+        return hit[1].copy()
+
+    def _mem_put(self, key, expiry, df):
+        if self.mem_size <= 0:
+            return
+        with self._mem_lock:
+            self._mem[key] = (expiry, df)
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_size:
+                self._mem.popitem(last=False)
+
     def can_cache(self):
         """returns a boolean that is True if the cache on disk is writable"""
 
@@ -59,18 +120,34 @@ class APICache:
             self.throttler = throttler
             self.cache_dir = cache_dir
             self.api_list = {}
+            self.lock = threading.Lock()
+            # reuse connections (and TLS sessions) across calls. The pool is
+            # big enough for LSTMHistory.ingest_index's fetch threads. Server
+            # errors are retried, then returned for pandify_fn to reject.
+            retry = Retry(total=3, backoff_factor=0.5, raise_on_status=False,
+                          status_forcelist=[429, 500, 502, 503, 504])
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16,
+                                  max_retries=retry)
+            self.session = requests.Session()
+            self.session.mount('https://', adapter)
+            self.session.mount('http://', adapter)
 
         def register_api(self, name, t):
             self.api_list[name] = t
 
         def get_api(self, name):
-            if name not in self.api_list:
+            call = self.api_list.get(name)
+            if call is None:
                 raise ValueError("API '{}' not registered.".format(name))
-            return self.api_list[name]
+            return call
 
+        # the stockaid.throttle classes are thread safe, but other throttlers
+        # might not be, so calls that arrive together from several threads
+        # take turns
         def throttle(self):
             if self.throttler:
-                self.throttler.throttle()
+                with self.lock:
+                    self.throttler.throttle()
 
 
     def register_provider(self, name, base_url, throttler=None):
@@ -92,7 +169,7 @@ class APICache:
 
     def register_api(self, provider, name, url, cache_field, pandify_fn,
             method='GET', url_params=[], data = None, data_params=[],
-            key_map={}, cache_secs=0):
+            key_map={}, cache_secs=0, binary=False):
         """Register an API call of a provider. Arguments describe how to call
            the API, and provide a pandify_fn that converts the returned json
            into pandas DataFrame.
@@ -104,12 +181,13 @@ class APICache:
                            cache.
                pandify_fn  is the function that converts the reponse text into
                            a pandas DataFrame. Return None on error.
-               method      is passed to requests.request. Usually GET or POST.
+               method      is passed to requests. Usually GET or POST.
                url_params  is a list of fields that should be used to format
                            the url.
                data        is the format string to use if the body of the post
                            must be json. In that case, data_params will be
-                           substituted into this string using format.
+                           substituted into this string by name using format,
+                           e.g. '{{"symbol": "{symbol}"}}'.
                data_params is a list of fields that should either be passed as
                            parameters or substituted into the json if provided
                            by the data argument.
@@ -123,27 +201,116 @@ class APICache:
                            them after.
                cache_secs  is the default number of seconds that calls to this
                            api should be cached. 0 means no caching.
+               binary      is a boolean. True will pass pandify_fn the bytes of
+                           the response instead of its decoded text, which
+                           skips a copy for parsers (like json) that accept
+                           bytes.
         """
 
-        if provider not in self.providers:
+        prov = self.providers.get(provider)
+        if prov is None:
             raise ValueError("Provider '{}' not registered.".format(provider))
 
-        cache_dir = None
-        if self.providers[provider].cache_dir:
-            cache_dir = os.path.join(self.providers[provider].cache_dir, name)
-            if not _check_cache_dir(cache_dir, self.mode):
-                cache_dir = None
-
-        if self.providers[provider].base_url:
-            api_url = '{}/{}'.format(self.providers[provider].base_url, url)
+        # cache files are named cache_prefix + key + cache_suffix
+        cache_prefix = None
+        if prov.cache_dir:
+            cache_dir = os.path.join(prov.cache_dir, name)
+            if _check_cache_dir(cache_dir, self.mode):
+                cache_prefix = os.path.join(cache_dir, '')
+        cache_suffix = '.' + _CACHE_EXT
+
+        # join with exactly one '/', whether or not base_url ends with one
+        if prov.base_url:
+            api_url = '{}/{}'.format(prov.base_url.rstrip('/'), url)
         else:
             api_url = url
 
-        t = {'url':api_url, 'method':method, 'cache_field':cache_field,
-                'pandify_fn':pandify_fn, 'url_params':url_params, 'data':data,
-                'data_params':data_params, 'key_map':key_map,
-                'cache_secs':cache_secs, 'cache_dir':cache_dir}
-        self.providers[provider].register_api(name, t)
+        # everything the call needs is bound here, once, so that each call
+        # does not look it up again. With no url_params, the url is constant.
+        url_params = tuple(url_params)
+        url_fmt = None
+        if url_params:
+            url_fmt = api_url.format_map
+        data_params = tuple(data_params)
+        data_fmt = None
+        if data:
+            data_fmt = data.format_map
+        # lookup api keys in our the key chain now, since it does not change.
+        # A missing key is only an error if the api is called.
+        key_chain = self.key_chain or {}
+        keys = {}
+        missing = None
+        for k, v in key_map.items():
+            if key_chain.get(v) is None:
+                missing = v
+            else:
+                keys[k] = key_chain[v]
+
+        def call(refresh, kwargs):
+            # see if a cached copy, in memory or on disk, is still valid
+            if cache_field:
+                key = kwargs[cache_field]
+            else:
+                key = name
+            mem_key = (provider, name, key)
+            if cache_secs and not refresh:
+                df = self._mem_get(mem_key)
+                if df is not None:
+                    return df
+            cache_file = None
+            if cache_prefix:
+                cache_file = cache_prefix + str(key) + cache_suffix
+            if cache_file and not refresh:
+                try:
+                    expiry = os.stat(cache_file).st_mtime + cache_secs
+                except OSError:
+                    expiry = 0
+                if expiry > time.time():
+                    df = _read_cache(cache_file)
+                    self._mem_put(mem_key, expiry, df)
+                    return df.copy()
+
+            # fetch and cache
+            if missing:
+                raise ValueError("Required key '{}' is missing".format(missing))
+            prov.throttle()
+
+            if url_fmt:
+                call_url = url_fmt({k: kwargs[k] for k in url_params})
+            else:
+                call_url = api_url
+
+            data_args = {k: kwargs[k] for k in data_params}
+            data_args.update(keys)
+
+            # the body is already json, so it is sent as is
+            body = None
+            if data_fmt:
+                body = data_fmt(data_args)
+
+            if body:
+                resp = prov.session.request(method, call_url, data=body,
+                        headers={'Content-Type': 'application/json'})
+            else:
+                resp = prov.session.request(method, call_url,
+                                            params=data_args)
+
+            # pandify
+            if binary:
+                df = pandify_fn(resp.content)
+            else:
+                df = pandify_fn(resp.text)
+
+            # cache
+            if df is not None and cache_secs:
+                if cache_file:
+                    _write_cache(df, cache_file)
+                self._mem_put(mem_key, time.time() + cache_secs, df)
+                df = df.copy()
+
+            return df
+
+        prov.register_api(name, call)
 
 
     def api(self, provider, name, refresh=False, **kwargs):
@@ -154,57 +321,39 @@ class APICache:
                refresh  is a boolean. True will ignore cached results.
                **kwargs are the set of fields that are specific to this api
         """
-        if provider not in self.providers:
+        prov = self.providers.get(provider)
+        if prov is None:
             raise ValueError("Provider '{}' not registered.".format(provider))
-        t = self.providers[provider].get_api(name)
-
-        # see if the cached copy is still valid
-        cache_file = None
-        if t['cache_dir']:
-            if t['cache_field']:
-                cache_file = os.path.join(t['cache_dir'],
-                        '{}.csv'.format(kwargs[t['cache_field']]))
-            else:
-                cache_file = os.path.join(t['cache_dir'],
-                        '{}.csv'.format(name))
-        if cache_file and os.path.exists(cache_file) and not refresh:
-            st = os.stat(cache_file)
-            now = datetime.now().timestamp()
-            if now - st.st_mtime < t['cache_secs']:
-                return pd.read_csv(cache_file)
-
-        # fetch and cache
-        self.providers[provider].throttle()
-
-        url_params = {}
-        for k in t['url_params']:
-            url_params[k] = kwargs[k]
-        url = t['url'].format(**url_params)
-
-        data_params = {}
-        for k in t['data_params']:
-            data_params[k] = kwargs[k]
-        # lookup api keys in our the key chain
-        for k in t['key_map'].keys():
-            v = t['key_map'][k]
-            if v not in self.key_chain or self.key_chain[v] is None:
-                raise ValueError("Required key '{}' is missing".format(v))
-            data_params[k] = self.key_chain[v]
-
-        data = None
-        if t['data']:
-            data = t['data'].format(data_params)
-
-        if data:
-            resp = requests.request(t['method'], url, json=data)
-        else:
-            resp = requests.request(t['method'], url, params=data_params)
-
-        # pandify
-        df = t['pandify_fn'](resp.text)
-
-        # cache
-        if cache_file and df is not None:
-            df.to_csv(cache_file)
-
-        return df
+        return prov.get_api(name)(refresh, kwargs)
+
+
+    def api_batch(self, provider, name, calls, refresh=False, max_workers=8):
+        """Call a registered API once for each set of fields in calls, several
+           at a time. Returns a list of the results (pandas DataFrames, or
+           None on error) in the same order as calls. The provider's throttler
+           is still respected, so this mostly helps when the calls are
+           waiting on the network.
+
+               provider    is the registered name of the provider
+               name        is the registered name of the api
+               calls       is a list of maps of the fields that are specific to
+                           this api, one per call, e.g. [{'symbol': 'AAPL'},
+                           {'symbol': 'MSFT'}]
+               refresh     is a boolean. True will ignore cached results.
+               max_workers is the number of calls to have in flight at once
+        """
+        prov = self.providers.get(provider)
+        if prov is None:
+            raise ValueError("Provider '{}' not registered.".format(provider))
+        call = prov.get_api(name)
+        calls = list(calls)
+        if max_workers <= 1 or len(calls) <= 1:
+            return [call(refresh, kwargs) for kwargs in calls]
+
+        pool = ThreadPoolExecutor(max_workers=min(max_workers, len(calls)))
+        try:
+            futures = [pool.submit(call, refresh, kwargs) for kwargs in calls]
+            return [f.result() for f in futures]
+        finally:
+            # don't start the rest of the calls if one of them raised
+            pool.shutdown(wait=False, cancel_futures=True)
@@ -13,16 +13,21 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from enum import Enum
+from enum import IntEnum
+from functools import lru_cache
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 
-class Future(Enum):
+# an IntEnum, so comparisons and the dispatch tables below hash and compare as
+# plain ints, and a raw int value is accepted anywhere a Future is
+class Future(IntEnum):
     FUTURE_DEFAULT = 0
     FUTURE_FIRST = 1
     FUTURE_MIN = 2
     FUTURE_MAX = 3
     FUTURE_LAST = 4
 
+@lru_cache(maxsize=None)
 def guess_algo(val_col):
     """Attempt to find an appropriate algo based on column name"""
     if val_col == 'open':
@@ -35,15 +40,42 @@ def guess_algo(val_col):
         # treat unknown column names like 'close'
         return Future.FUTURE_LAST
 
+# the ways to pick a value from a future, and from each row of futures. Any
+# algo not listed (including FUTURE_DEFAULT) is treated like FUTURE_LAST.
+_VAL = {
+    Future.FUTURE_FIRST: lambda f: f[0],
+    Future.FUTURE_MAX: np.amax,
+    Future.FUTURE_MIN: np.amin,
+}
+_VAL_BATCH = {
+    Future.FUTURE_FIRST: lambda f: f[:, 0],
+    Future.FUTURE_MAX: lambda f: np.amax(f, axis=1),
+    Future.FUTURE_MIN: lambda f: np.amin(f, axis=1),
+}
+
+def _last(future):
+    return future[-1]
+
+def _last_batch(futures):
+    return futures[:, -1]
+
 def future_val(future, future_algo):
     """Extract a future value using a future_algo
-       future must be a numpy array
+       future must be a numpy array. To extract many future values, use
+       future_val_batch or future_vals, which are much faster than a loop.
     """
-    if future_algo == Future.FUTURE_FIRST:
-        return future[0]
-    elif future_algo == Future.FUTURE_MAX:
-        return np.amax(future)
-    elif future_algo == Future.FUTURE_MIN:
-        return np.amin(future)
-    else:
-        return future[-1]
+    return _VAL.get(future_algo, _last)(future)
+
+def future_val_batch(futures, future_algo):
+    """Extract a future value from each row using a future_algo
+       futures must be a two dimensional numpy array, one future per row
+    """
+    return _VAL_BATCH.get(future_algo, _last_batch)(futures)
+
+def future_vals(series, window, future_algo):
+    """Extract a future value using a future_algo from every window of the
+       given size in a series, in one pass. Row i of the result is the value
+       for series[i:i+window].
+       series must be a one dimensional numpy array
+    """
+    return future_val_batch(sliding_window_view(series, window), future_algo)
@@ -20,6 +20,9 @@
    or a predicted change in interest rates.
 """
 
+import math
+import numpy as np
+
 def option_change(underlying_change, days_in_future, delta, gamma, theta):
     """It is common to close an option position without exercising. In those
        cases, the change in the underlying security does not equal the change
@@ -48,28 +51,41 @@ def option_change(underlying_change, days_in_future, delta, gamma, theta):
     gamma=float(gamma)
     theta=float(theta)
 
+    # NaN greeks (which TDA chains do report) pass the bounds check, and
+    # make the change NaN
+    if math.isnan(underlying_change) or math.isnan(delta) or \
+            math.isnan(gamma) or math.isnan(theta):
+        return float('nan')
+
     # sanity check the greeks
     if delta < -1 or delta > 1 or gamma < 0 or gamma > 1:
         raise ValueError("Greeks out of bounds!")
 
-    change = 0.0
     sign = 1
     if underlying_change < 0:
         sign = -1
-    # whole dollars
-    while abs(underlying_change) > 1:
-        change = change + (sign * delta)
-        underlying_change = underlying_change - sign
-        delta = delta + (sign * gamma) # gamma is always positive
-        # abs(delta) can never be > 1. This limit seeks to hedge against errors
-        # introduced over a large number of days. In reality, gamma will also
-        # adjust over time so that this limit is not actually needed when using
-        # current values -- we are predicting the future. The rate at which
-        # gamma changes over time (i.e. the third derivative of the price of
-        # the underlying) is not a published Greek. That change is usually
-        # insignificant over small changes to the price of the underlying.
-        delta = min(delta, 1)
-        delta = max(delta, -1)
+    # whole dollars: measured in the direction of the change, each dollar
+    # moves the option by d, and then d grows by gamma (always positive), up
+    # to 1. So the change is an arithmetic series, then 1 per dollar once d
+    # reaches the limit. abs(delta) can never be > 1. This limit seeks to
+    # hedge against errors introduced over a large number of days. In
+    # reality, gamma will also adjust over time so that this limit is not
+    # actually needed when using current values -- we are predicting the
+    # future. The rate at which gamma changes over time (i.e. the third
+    # derivative of the price of the underlying) is not a published Greek.
+    # That change is usually insignificant over small changes to the price
+    # of the underlying.
+    n = max(0, math.ceil(abs(underlying_change)) - 1)
+    d = sign * delta
+    # dollars before the limit. Compared without dividing first, since for
+    # a tiny (or zero) gamma the quotient is too big for ceil.
+    if (1 - d) >= gamma * n:
+        n_free = n
+    else:
+        n_free = math.ceil((1 - d) / gamma)
+    change = (n_free * d) + (gamma * n_free * (n_free - 1) / 2) + (n - n_free)
+    underlying_change = underlying_change - (sign * n)
+    delta = sign * min(d + (gamma * n), 1)
     # leftover fraction
     change = change + (delta * underlying_change)
 
@@ -80,6 +96,39 @@ def option_change(underlying_change, days_in_future, delta, gamma, theta):
     return change
 
 
+def option_change_vec(underlying_change, days_in_future, delta, gamma,
+                      theta):
+    """This is option_change() for many options at once, e.g. an entire
+       option chain. The arguments are the same as for option_change(), except
+       that each may be an array-like (such as a column of a DataFrame) or a
+       scalar, and they are broadcast against each other. Returns an ndarray
+       of floats.
+    """
+
+    underlying_change = np.asarray(underlying_change, dtype=float)
+    days_in_future = np.asarray(days_in_future).astype(int)
+    delta = np.asarray(delta, dtype=float)
+    gamma = np.asarray(gamma, dtype=float)
+    theta = np.asarray(theta, dtype=float)
+
+    # sanity check the greeks
+    if np.any((delta < -1) | (delta > 1) | (gamma < 0) | (gamma > 1)):
+        raise ValueError("Greeks out of bounds!")
+
+    # the same closed form as option_change(), see the comments there. Where
+    # gamma is 0, the division is not used.
+    sign = np.where(underlying_change < 0, -1.0, 1.0)
+    n = np.maximum(0, np.ceil(np.abs(underlying_change)) - 1)
+    d = sign * delta
+    with np.errstate(divide='ignore', over='ignore', invalid='ignore'):
+        n_free = np.where(gamma > 0, np.minimum(n, np.ceil((1 - d) / gamma)),
+                          n)
+    change = (n_free * d) + (gamma * n_free * (n_free - 1) / 2) + (n - n_free)
+    delta = sign * np.minimum(d + (gamma * n), 1)
+    change = change + (delta * (underlying_change - (sign * n)))
+    return change + (days_in_future * theta)
+
+
 def adjust_for_vega(predicted_volatility_change, vega):
     """Option prices can change in response to a change in volatility over some
        time period. The time period does not matter, as long as your prediction
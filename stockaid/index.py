@@ -14,126 +14,140 @@
 # limitations under the License.
 
 
-from html.parser import HTMLParser
+import re
 from html import unescape
 from .throttle import CrudeThrottler
 import pandas as pd
 
-class _WikiTableParser(HTMLParser):
+# wiki markup that is removed from table cells. Only the first match in a cell
+# is used, and the text around it is dropped.
+#   [[key]] or [[key|text]] is a link to a wiki page
+#   [url text] is an external link
+#   {{something|key}} is a wiki template
+_LINK = re.compile(r'\[\[(.*?)\]\]', re.S)
+_EXTLINK = re.compile(r'\[(.*?)\]', re.S)
+_TEMPLATE = re.compile(r'\{\{(.*?)\}\}', re.S)
+
+# the wiki source of the table is the body of the edit page's textarea. The
+# start tag and the end tag are found separately, since a lazy match of the
+# body in between tests each character of it for the end tag. Tag and
+# attribute names are case-insensitive, like html, but the id is not. The
+# bytes versions let the page be searched before it is decoded.
+_TEXTAREA = (r'''<(?i:textarea)\b[^>]*?\s(?i:id)\s*=\s*(["']?)wpTextbox1\1'''
+             r'(?=[\s/>])[^>]*>')
+_TEXTAREA_END = r'</(?i:textarea)\s*>'
+_TEXTAREA_STR = (re.compile(_TEXTAREA), re.compile(_TEXTAREA_END))
+_TEXTAREA_BYTES = (re.compile(_TEXTAREA.encode()),
+                   re.compile(_TEXTAREA_END.encode()))
+
+class _WikiTableParser:
     def __init__(self):
-        super().__init__()
-        self.in_textarea = False
         self.scraped = ""
-
-    def handle_starttag(self, tag, attrs):
-        if tag == 'textarea':
-            for t in attrs:
-                if t[0] == 'id' and t[1] == 'wpTextbox1':
-                    self.in_textarea = True
-
-    def handle_endtag(self, tag):
-        if self.in_textarea and tag == 'textarea':
-            self.in_textarea = False
-
-    def handle_data(self, data):
-        if self.in_textarea:
-            self.scraped = self.scraped + data
-
-    # unwrap link markup, e.g. [[key|text]]
-    def _unwrap(self, s, d1, d2, d3):
-        start = s.find(d1)
-        if start >= 0:
-            start = start + len(d1)
-            end = s.find(d2, start)
-            if end >= 0:
-                s = s[start:end]
-                start = s.find(d3)
-                if start >= 0:
-                    return [s[:start], s[start+1:]]
-        return [s, ""]
-
-    # extract columns into a list
+        # the rows of the table, prepared by the first call to wiki_rows
+        self._rows = None
+
+    # only the one textarea is wanted, so a regex finds it rather than
+    # running an html parser over the whole page. Like that parser, the
+    # character references in its body are converted here. html may be the
+    # str or the utf-8 bytes of the page. For bytes, only the textarea is
+    # decoded.
+    def feed(self, html):
+        binary = isinstance(html, bytes)
+        start_tag, end_tag = _TEXTAREA_BYTES if binary else _TEXTAREA_STR
+        m = start_tag.search(html)
+        if not m:
+            return
+        start = m.end()
+        m = end_tag.search(html, start)
+        end = m.start() if m else len(html)
+        # wiki_rows skips to the table anyway, so what comes before it is
+        # not kept, decoded, or unescaped
+        table = html.find(b'wikitable' if binary else 'wikitable', start, end)
+        if table >= 0:
+            start = table
+        body = html[start:end]
+        if binary:
+            body = body.decode('utf-8', 'replace')
+        self.scraped = unescape(body)
+        self._rows = None
+
+    # unwrap markup matched by pattern, e.g. [[key|text]], and split what
+    # was inside it at the first d3. Returns the two parts as a tuple.
+    @staticmethod
+    def _unwrap(s, pattern, d3):
+        m = pattern.search(s)
+        if m:
+            head, _, tail = m.group(1).partition(d3)
+            return head, tail
+        return s, ""
+
+    # extract columns into a list. Each column follows a delim.
     def _get_cols(self, row, delim):
         cols = []
-        end = row.find(delim)
-        while end >= 0:
-            start = end + len(delim)
-            end = row.find(delim, start)
-            if end < 0:
-                col = row[start:]
-            else:
-                col = row[start:end]
-
-            # remove wiki markup
+        # locals, since these are used for every cell of the table
+        append = cols.append
+        unwrap = self._unwrap
+        for col in row.split(delim)[1:]:
+            # remove wiki markup. Most cells have little or none, so each
+            # kind is only searched for when its opening delimiter is there.
             # [[key]] or [[key|text]] is a link to a wiki page. Take text
-            parts = self._unwrap(col, '[[', ']]', '|')
-            if parts[1] == "":
-                col = parts[0]
-            else:
-                col = parts[1]
+            if '[[' in col:
+                key, text = unwrap(col, _LINK, '|')
+                col = text or key
 
             # [url text] is an external link. Take the url
-            parts = self._unwrap(col, '[', ']', ' ')
-            col = parts[0]
+            if '[' in col:
+                col = unwrap(col, _EXTLINK, ' ')[0]
 
             # {{something|key}} is a wiki template. Take the key
-            parts = self._unwrap(col, '{{', '}}', '|')
-            if parts[1]:
-                col = parts[1]
-            else:
-                col = parts[0]
+            if '{{' in col:
+                name, key = unwrap(col, _TEMPLATE, '|')
+                col = key or name
 
-            cols.append(col.strip())
+            append(col.strip())
         return cols
 
     # generator, yields one row at a time as a list of column values
     def wiki_rows(self):
-        table = unescape(self.scraped)
-        found_head = False
-        start = table.find('wikitable')
-        if start < 0:
-            start = 0
-        end = table.find('\n|-', start)
-        while end > 0:
-            start = end + 3
-            end = table.find('\n|-', start)
-            if end < 0:
-                row = table[start:]
-            else:
-                row = table[start:end]
-
-            # first row is column names, delimited by !!, rest by ||
-            if not found_head:
-                row = row.replace('\n', '!')
-                col_names = self._get_cols(row, '!!')
-                num_cols = len(col_names)
-                found_head = True
-                yield col_names
-            else:
-                row = row.replace('\n', '|')
-                a = self._get_cols(row, '||')
-                yield [a[0:num_cols]]
+        rows = self._rows
+        if rows is None:
+            table = unescape(self.scraped)
+            start = table.find('wikitable')
+            if start < 0:
+                start = 0
+            # rows are separated by \n|-, and what comes before the first is
+            # not a row
+            rows = self._rows = table[start:].split('\n|-')
+        if len(rows) < 2:
+            return
+
+        # first row is column names, delimited by !!, rest by ||
+        col_names = self._get_cols(rows[1].replace('\n', '!'), '!!')
+        num_cols = len(col_names)
+        yield col_names
+        get_cols = self._get_cols
+        for i in range(2, len(rows)):
+            a = get_cols(rows[i].replace('\n', '|'), '||')
+            yield a[0:num_cols]
 
 
 def pandify_index(html):
-    """This pandify_fn converts a wiki table to a pandas DataFrame."""
+    """This pandify_fn converts a wiki table to a pandas DataFrame. html is
+       the text or the utf-8 bytes of a wikipedia edit page.
+    """
 
     wtp = _WikiTableParser()
     wtp.feed(html)
-    wtp.close()
 
-    cols = None
-    df = None
-    for row in wtp.wiki_rows():
-        if not cols:
-            cols=row
-        elif df is None:
-            df = pd.DataFrame(row, columns=cols)
-        else:
-            r = pd.DataFrame(row, columns=cols)
-            df = df.append(r)
+    # the first row is the column names. The rest are collected by list, in
+    # C, and the DataFrame is built once.
+    it = wtp.wiki_rows()
+    cols = next(it, None)
+    rows = list(it)
 
-    return df
+    if not rows:
+        return None
+    return pd.DataFrame(rows, columns=cols)
 
 # All of these are cached for a week. Throttled to 10 requests / min.
 # index sp500      S&P 500 Index
@@ -142,6 +156,22 @@ def pandify_index(html):
 # index smallcap   S&P SmallCap 600 Index
 # index nasdaq100  Nasdaq 100
 # index DJIA       Dow Jones Industrial Average
+# Each is the name of the api, the wikipedia page, and the section of that
+# page holding the table.
+_INDEX_SPECS = (
+    ('sp500', 'List_of_S%26P_500_companies', 1),
+    ('OEX', 'S%26P_100', 3),
+    ('midcap', 'List_of_S%26P_400_companies', 1),
+    ('smallcap', 'List_of_S%26P_600_companies', 1),
+    ('nasdaq100', 'Nasdaq-100', 13),
+    ('DJIA', 'Dow_Jones_Industrial_Average', 1),
+)
+_INDEX_URL = 'w/index.php?title={}&action=edit&section={}'
+_INDEX_SECS = 604800
+# the name and url of each api, built once at import
+_INDEX_APIS = tuple((name, _INDEX_URL.format(title, section))
+                    for name, title, section in _INDEX_SPECS)
+
 def register_index(cache):
     """This function registers the api call for the index provider. Normally,
        this is done for you as part of the stockaid.get_cache() function.
@@ -149,21 +179,6 @@ def register_index(cache):
 
     throt = CrudeThrottler(10)
     cache.register_provider('index', 'https://en.wikipedia.org/', throt)
-    cache.register_api('index', 'sp500',
-        "w/index.php?title=List_of_S%26P_500_companies&action=edit&section=1",
-        None, pandify_index, cache_secs=604800)
-    cache.register_api('index', 'OEX',
-        'w/index.php?title=S%26P_100&action=edit&section=3',
-        None, pandify_index, cache_secs=604800)
-    cache.register_api('index', 'midcap',
-        'w/index.php?title=List_of_S%26P_400_companies&action=edit&section=1',
-        None, pandify_index, cache_secs=604800)
-    cache.register_api('index', 'smallcap',
-        'w/index.php?title=List_of_S%26P_600_companies&action=edit&section=1',
-        None, pandify_index, cache_secs=604800)
-    cache.register_api('index', 'nasdaq100',
-        'w/index.php?title=Nasdaq-100&action=edit&section=13',
-        None, pandify_index, cache_secs=604800)
-    cache.register_api('index', 'DJIA',
-        'w/index.php?title=Dow_Jones_Industrial_Average&action=edit&section=1',
-        None, pandify_index, cache_secs=604800)
+    for name, url in _INDEX_APIS:
+        cache.register_api('index', name, url, None, pandify_index,
+                           cache_secs=_INDEX_SECS, binary=True)
@@ -15,13 +15,18 @@
 
 _stockaid_user_logging_fn = None
 _stockaid_log_level = 2
+# where messages that pass the level check go, resolved when it is set so
+# that log doesn't have to
+_stockaid_log_sink = print
 
 def set_log_fn(fn):
     """Define an external function to use for logging messages. This function
        should except a single string as an argument.
     """
     global _stockaid_user_logging_fn
+    global _stockaid_log_sink
     _stockaid_user_logging_fn = fn
+    _stockaid_log_sink = print if fn is None else fn
 
 
 def set_log_level(l):
@@ -36,15 +41,8 @@ def set_log_level(l):
     _stockaid_log_level = l
 
 
+# the other modules import this function by name, so it stays the same
+# function, and a rejected message costs one compare
 def log(level, s):
-    global _stockaid_user_logging_fn
-    global _stockaid_log_level
-
-    if level > _stockaid_log_level:
-        return
-
-    if _stockaid_user_logging_fn is None:
-        print(s)
-    else:
-        _stockaid_user_logging_fn(s)
-
+    if level <= _stockaid_log_level:
+        _stockaid_log_sink(s)
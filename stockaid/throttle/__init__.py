@@ -13,54 +13,84 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Implementations of throttling functions."""
+"""Implementations of throttling functions. Each throttler is safe to share
+   between threads; calls to throttle take turns. A throttler's cancel
+   function wakes any call that is waiting, and no call waits after it, which
+   is meant for shutting down.
+"""
 
 import time
+import threading
+from collections import deque
 
 class CrudeThrottler:
-    """This throttler is crude. It makes calls_per_min calls then sleeps for
-       a minute.
+    """This throttler is crude. It allows calls_per_min calls in any sliding
+       60 second window. Once the window is full, it sleeps until the oldest
+       call in the window is a minute old.
     """
 
     def __init__(self, calls_per_min):
         self.cpm = calls_per_min
-        self.count = 0
+        # monotonic times of the most recent calls, oldest first
+        self.times = deque(maxlen=max(calls_per_min, 1))
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
 
     def throttle(self):
-        self.count = self.count + 1
-        if self.count > self.cpm:
-            self.count = 0
-            time.sleep(60)
+        with self._lock:
+            now = time.monotonic()
+            if len(self.times) == self.times.maxlen:
+                wait = 60 - (now - self.times[0])
+                # a True wait means cancel was called
+                if wait > 0 and not self._wake.wait(wait):
+                    now = time.monotonic()
+            self.times.append(now)
+
+    def cancel(self):
+        """Wake any waiting call to throttle, and stop throttling."""
+        self._wake.set()
 
 
 class LazyTokenBucket:
     """This throttler is similar to the well known Token Bucket algorithm,
        except tokens are only added to the bucket when the throttle function
        is called, and all withdrawals are for one token. The last call time is
-       stored to allow us to lazy-add the correct number of tokens. Sleeps in
-       one second increments. Not a good fit for rates less than 60 calls per
-       minute.
+       stored to allow us to lazy-add the correct number of tokens. When the
+       bucket is empty, sleeps just long enough for the next token.
     """
 
     def __init__(self, calls_per_min):
         self.M = calls_per_min      # Max size of bucket
         self.b = self.M             # number in the bucket
         self.r = self.M / 60        # rate that tokens are added
-        self.last = time.time()
+        self._inv_r = 60 / self.M   # seconds per token
+        self.last = time.monotonic()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
 
     def throttle(self):
-        # the lazy part -- catch the bucket up
-        now = time.time()
-        self.b = self.b + (self.r * (now - self.last))
-        if self.b > self.M:
-            self.b = self.M
-        self.last = now
+        M = self.M
+        r = self.r
+        with self._lock:
+            while True:
+                # the lazy part -- catch the bucket up
+                now = time.monotonic()
+                b = self.b + (r * (now - self.last))
+                if b > M:
+                    b = M
+                self.b = b
+                self.last = now
+                if b >= 1:
+                    break
 
-        # maybe sleep
-        if self.b < 1:
-            time.sleep(1)
-            return self.throttle()
+                # sleep until there is a token. A True wait means cancel was
+                # called, so don't wait for the token.
+                if self._wake.wait(max(0.01, (1 - b) * self._inv_r)):
+                    return
 
-        # now deduct the token we are consuming
-        self.b = self.b - 1
+            # now deduct the token we are consuming
+            self.b = b - 1
 
+    def cancel(self):
+        """Wake any waiting call to throttle, and stop throttling."""
+        self._wake.set()